@@ -134,6 +134,76 @@ def generate_launch_description():
             description="Whether to use high-resolution segmentation masks if available in the model, enhancing mask quality for segmentation",
         )
 
+        use_tensorrt = LaunchConfiguration("use_tensorrt")
+        use_tensorrt_cmd = DeclareLaunchArgument(
+            "use_tensorrt",
+            default_value="False",
+            description="Whether to export the model to a TensorRT FP16 engine when running on CUDA",
+        )
+
+        use_onnxrt = LaunchConfiguration("use_onnxrt")
+        use_onnxrt_cmd = DeclareLaunchArgument(
+            "use_onnxrt",
+            default_value="False",
+            description="Whether to export the model to ONNX and run it with ONNX Runtime when running on CPU",
+        )
+
+        int8 = LaunchConfiguration("int8")
+        int8_cmd = DeclareLaunchArgument(
+            "int8",
+            default_value="False",
+            description="Whether to calibrate and use a TensorRT INT8 engine when running on CUDA",
+        )
+
+        calib_num = LaunchConfiguration("calib_num")
+        calib_num_cmd = DeclareLaunchArgument(
+            "calib_num",
+            default_value="300",
+            description="Number of frames used for the INT8 calibration",
+        )
+
+        channels_last = LaunchConfiguration("channels_last")
+        channels_last_cmd = DeclareLaunchArgument(
+            "channels_last",
+            default_value="False",
+            description="Whether to use the channels last memory format (requires CUDA and half)",
+        )
+
+        cuda_preprocess = LaunchConfiguration("cuda_preprocess")
+        cuda_preprocess_cmd = DeclareLaunchArgument(
+            "cuda_preprocess",
+            default_value="False",
+            description="Whether to letterbox the input images on the GPU using pinned memory uploads",
+        )
+
+        reuse_buffers = LaunchConfiguration("reuse_buffers")
+        reuse_buffers_cmd = DeclareLaunchArgument(
+            "reuse_buffers",
+            default_value="False",
+            description="Whether to letterbox the input images into preallocated buffers reused across frames",
+        )
+
+        async_pipeline = LaunchConfiguration("async_pipeline")
+        async_pipeline_cmd = DeclareLaunchArgument(
+            "async_pipeline",
+            default_value="False",
+            description="Whether to overlap image uploads with inference using CUDA streams (requires cuda_preprocess)",
+        )
+
+        batch_size = LaunchConfiguration("batch_size")
+        batch_size_cmd = DeclareLaunchArgument(
+            "batch_size",
+            default_value="1",
+            description="Maximum number of images inferred together in a single batch",
+        )
+
+        batch_timeout = LaunchConfiguration("batch_timeout")
+        batch_timeout_cmd = DeclareLaunchArgument(
+            "batch_timeout",
+            default_value="0.02",
+            description="Maximum time in seconds to wait before inferring an incomplete batch",
+        )
+
         input_image_topic = LaunchConfiguration("input_image_topic")
         input_image_topic_cmd = DeclareLaunchArgument(
             "input_image_topic",
@@ -144,7 +214,7 @@ def generate_launch_description():
         image_reliability = LaunchConfiguration("image_reliability")
         image_reliability_cmd = DeclareLaunchArgument(
             "image_reliability",
-            default_value="1",
+            default_value="2",
             choices=["0", "1", "2"],
             description="Specific reliability QoS of the input image topic (0=system default, 1=Reliable, 2=Best Effort)",
         )
@@ -254,6 +324,16 @@ def generate_launch_description():
                     "augment": augment,
                     "agnostic_nms": agnostic_nms,
                     "retina_masks": retina_masks,
+                    "use_tensorrt": use_tensorrt,
+                    "use_onnxrt": use_onnxrt,
+                    "int8": int8,
+                    "calib_num": calib_num,
+                    "channels_last": channels_last,
+                    "cuda_preprocess": cuda_preprocess,
+                    "reuse_buffers": reuse_buffers,
+                    "async_pipeline": async_pipeline,
+                    "batch_size": batch_size,
+                    "batch_timeout": batch_timeout,
                     "image_reliability": image_reliability,
                     "publish_result_img": publish_result_img,
                 }
@@ -322,6 +402,16 @@ def generate_launch_description():
             augment_cmd,
             agnostic_nms_cmd,
             retina_masks_cmd,
+            use_tensorrt_cmd,
+            use_onnxrt_cmd,
+            int8_cmd,
+            calib_num_cmd,
+            channels_last_cmd,
+            cuda_preprocess_cmd,
+            reuse_buffers_cmd,
+            async_pipeline_cmd,
+            batch_size_cmd,
+            batch_timeout_cmd,
             input_image_topic_cmd,
             image_reliability_cmd,
             input_depth_topic_cmd,
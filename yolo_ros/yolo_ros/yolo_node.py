@@ -13,14 +13,20 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import os
 import time
+import yaml
+import queue
+import threading
 import traceback
 
 import cv2
-from typing import List, Dict
+import numpy as np
+from typing import List, Dict, Tuple, Optional
 from cv_bridge import CvBridge
 
 import rclpy
+from rclpy.logging import LoggingSeverity
 from rclpy.qos import QoSProfile
 from rclpy.qos import QoSHistoryPolicy
 from rclpy.qos import QoSDurabilityPolicy
@@ -28,15 +34,16 @@ from rclpy.qos import QoSReliabilityPolicy
 from rclpy.lifecycle import LifecycleNode
 from rclpy.lifecycle import TransitionCallbackReturn
 from rclpy.lifecycle import LifecycleState
+from rclpy.executors import MultiThreadedExecutor
+from rclpy.callback_groups import MutuallyExclusiveCallbackGroup
 
 import torch
 
 # from ultralytics import YOLO, YOLOWorld, YOLOE
 from ultralytics import YOLO, YOLOWorld
+from ultralytics.engine.predictor import BasePredictor
 from ultralytics.engine.results import Results
-from ultralytics.engine.results import Boxes
-from ultralytics.engine.results import Masks
-from ultralytics.engine.results import Keypoints
+from ultralytics.utils.plotting import colors
 
 from std_srvs.srv import SetBool
 from sensor_msgs.msg import Image
@@ -49,6 +56,26 @@ from yolo_msgs.msg import Detection
 from yolo_msgs.msg import DetectionArray
 from yolo_msgs.srv import SetClasses
 
+try:
+    from numba import njit
+except ImportError:
+
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+
+COLORS = [colors(i, True) for i in range(colors.n)]
+
+
+@njit(cache=True)
+def assemble_detections(
+    boxes: np.ndarray, cls: np.ndarray, conf: np.ndarray, threshold: float
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+
+    # compact arrays of the detections over the threshold
+    keep = np.nonzero(conf >= threshold)[0]
+    return keep, boxes[keep], cls[keep], conf[keep]
+
 
 class YoloNode(LifecycleNode):
 
@@ -61,7 +88,7 @@ class YoloNode(LifecycleNode):
         self.declare_parameter("device", "cpu")
         self.declare_parameter("yolo_encoding", "bgr8")
         self.declare_parameter("enable", True)
-        self.declare_parameter("image_reliability", QoSReliabilityPolicy.RELIABLE)
+        self.declare_parameter("image_reliability", QoSReliabilityPolicy.BEST_EFFORT)
 
         self.declare_parameter("threshold", 0.5)
         self.declare_parameter("iou", 0.5)
@@ -72,10 +99,35 @@ class YoloNode(LifecycleNode):
         self.declare_parameter("augment", False)
         self.declare_parameter("agnostic_nms", False)
         self.declare_parameter("retina_masks", False)
+        self.declare_parameter("use_tensorrt", False)
+        self.declare_parameter("use_onnxrt", False)
+        self.declare_parameter("int8", False)
+        self.declare_parameter("calib_num", 300)
+        self.declare_parameter("channels_last", False)
+        self.declare_parameter("cuda_preprocess", False)
+        self.declare_parameter("reuse_buffers", False)
+        self.declare_parameter("async_pipeline", False)
+        self.declare_parameter("batch_size", 1)
+        self.declare_parameter("batch_timeout", 0.02)
 
         self.declare_parameter("publish_result_img", False)
         self.declare_parameter("auto_activate", True)
 
+        # inference runs apart from services and timers in a multithreaded executor
+        self._infer_cbg = MutuallyExclusiveCallbackGroup()
+        self._srv_cbg = MutuallyExclusiveCallbackGroup()
+
+        # guards the active flag against callbacks racing the deactivation
+        self._state_lock = threading.Lock()
+        self._active = False
+        self._generation = 0
+
+        # INT8 calibration may outlive the activation that started it
+        self._calib_thread = None
+
+        # serializes inference with model swaps and teardown
+        self._infer_lock = threading.Lock()
+
         # self.type_to_model = {"YOLO": YOLO, "World": YOLOWorld, "YOLOE": YOLOE}
         self.type_to_model = {"YOLO": YOLO, "World": YOLOWorld}
 
@@ -91,7 +143,13 @@ class YoloNode(LifecycleNode):
         self.model = self.get_parameter("model").get_parameter_value().string_value
         self.device = self.get_parameter("device").get_parameter_value().string_value
         if "cuda" in self.device:
-            self.get_logger().info( f"cuda available = {torch.cuda.is_available()}")        
+            self.get_logger().info(f"cuda available = {torch.cuda.is_available()}")
+
+            # imgsz is fixed, so cuDNN autotuning pays off after the first frames
+            torch.set_float32_matmul_precision("high")
+            torch.backends.cudnn.benchmark = True
+            torch.backends.cuda.matmul.allow_tf32 = True
+
         self.yolo_encoding = (
             self.get_parameter("yolo_encoding").get_parameter_value().string_value
         )
@@ -108,6 +166,15 @@ class YoloNode(LifecycleNode):
             self.get_parameter("imgsz_width").get_parameter_value().integer_value
         )
         self.half = self.get_parameter("half").get_parameter_value().bool_value
+        if self.half and "cuda" not in self.device:
+            self.get_logger().warn("Disabling half: not supported on CPU")
+            self.half = False
+        elif self.half and (
+            not torch.cuda.is_available()
+            or torch.cuda.get_device_capability(self.device)[0] < 7
+        ):
+            self.get_logger().warn("Disabling half: device lacks fast FP16")
+            self.half = False
         self.max_det = self.get_parameter("max_det").get_parameter_value().integer_value
         self.augment = self.get_parameter("augment").get_parameter_value().bool_value
         self.agnostic_nms = (
@@ -116,6 +183,42 @@ class YoloNode(LifecycleNode):
         self.retina_masks = (
             self.get_parameter("retina_masks").get_parameter_value().bool_value
         )
+        self.use_tensorrt = (
+            self.get_parameter("use_tensorrt").get_parameter_value().bool_value
+        )
+        self.use_onnxrt = (
+            self.get_parameter("use_onnxrt").get_parameter_value().bool_value
+        )
+        self.int8 = self.get_parameter("int8").get_parameter_value().bool_value
+        self.calib_num = (
+            self.get_parameter("calib_num").get_parameter_value().integer_value
+        )
+        self.channels_last = (
+            self.get_parameter("channels_last").get_parameter_value().bool_value
+        )
+        self.cuda_preprocess = (
+            self.get_parameter("cuda_preprocess").get_parameter_value().bool_value
+        )
+        self.reuse_buffers = (
+            self.get_parameter("reuse_buffers").get_parameter_value().bool_value
+        )
+        self.async_pipeline = (
+            self.get_parameter("async_pipeline").get_parameter_value().bool_value
+        )
+        self.batch_size = (
+            self.get_parameter("batch_size").get_parameter_value().integer_value
+        )
+        self.batch_timeout = (
+            self.get_parameter("batch_timeout").get_parameter_value().double_value
+        )
+        if self.int8 and self.calib_num < max(1, self.batch_size):
+            self.get_logger().error(
+                f"calib_num must be at least max(1, batch_size), got {self.calib_num}"
+            )
+            return TransitionCallbackReturn.FAILURE
+
+        # per-frame timing is only computed when it will be logged
+        self._do_timing = self.get_logger().get_effective_level() <= LoggingSeverity.DEBUG
 
         # ros params
         self.enable = self.get_parameter("enable").get_parameter_value().bool_value
@@ -131,6 +234,14 @@ class YoloNode(LifecycleNode):
             depth=1,
         )
 
+        # result images are published reliably, whatever the input reliability
+        self.result_img_qos_profile = QoSProfile(
+            reliability=QoSReliabilityPolicy.RELIABLE,
+            history=QoSHistoryPolicy.KEEP_LAST,
+            durability=QoSDurabilityPolicy.VOLATILE,
+            depth=1,
+        )
+
         self.publish_result_img = (
             self.get_parameter("publish_result_img").get_parameter_value().bool_value
         )
@@ -142,7 +253,7 @@ class YoloNode(LifecycleNode):
             DetectionArray, "detections", 10
         )
         self._image_pub = (
-            self.create_publisher(Image, "detections_img", self.image_qos_profile)
+            self.create_publisher(Image, "detections_img", self.result_img_qos_profile)
             if self.publish_result_img
             else None
         )
@@ -152,7 +263,9 @@ class YoloNode(LifecycleNode):
         self.get_logger().info(f"[{self.get_name()}] Configured")
 
         if self.auto_activate:
-            self.activate_timer = self.create_timer(0.1, self._activate)
+            self.activate_timer = self.create_timer(
+                0.1, self._activate, callback_group=self._srv_cbg
+            )
 
         return TransitionCallbackReturn.SUCCESS
 
@@ -166,31 +279,185 @@ class YoloNode(LifecycleNode):
         try:
             self.get_logger().info(f"[{self.get_name()}] Activating...")
 
+            self.model_path = self.model
+            if self.use_tensorrt and "cuda" in self.device and self.model.endswith(".pt"):
+                try:
+                    self.model_path = self.export_model(
+                        f"_{self.imgsz_height}x{self.imgsz_width}"
+                        f"_b{self.batch_size}_fp16.engine",
+                        format="engine",
+                        imgsz=(self.imgsz_height, self.imgsz_width),
+                        half=True,
+                        device=self.device,
+                        dynamic=self.batch_size > 1,
+                        batch=self.batch_size,
+                    )
+                except FileNotFoundError:
+                    self.get_logger().error(f"Model file '{self.model}' does not exists")
+                    return TransitionCallbackReturn.ERROR
+                except Exception as e:
+                    self.get_logger().warn(f"Error while exporting to TensorRT: {e}")
+
+            # ONNX Runtime applies Conv+BN+activation graph fusions on CPU
+            if self.use_onnxrt and self.device == "cpu" and self.model.endswith(".pt"):
+                try:
+                    self.model_path = self.export_model(
+                        f"_{self.imgsz_height}x{self.imgsz_width}_b{self.batch_size}.onnx",
+                        format="onnx",
+                        opset=17,
+                        simplify=True,
+                        imgsz=(self.imgsz_height, self.imgsz_width),
+                        half=False,
+                        device=self.device,
+                        dynamic=self.batch_size > 1,
+                        batch=self.batch_size,
+                    )
+                except FileNotFoundError:
+                    self.get_logger().error(f"Model file '{self.model}' does not exists")
+                    return TransitionCallbackReturn.ERROR
+                except Exception as e:
+                    self.get_logger().warn(f"Error while exporting to ONNX: {e}")
+
+            # INT8 engines are calibrated with the first received frames
+            self._calibrate = False
+            self._calib_buf = None
+            self._calib_shape = None
+            self._calib_count = 0
+            if self.int8 and "cuda" in self.device and self.model.endswith(".pt"):
+                int8_path = (
+                    os.path.splitext(self.model)[0]
+                    + f"_{self.imgsz_height}x{self.imgsz_width}"
+                    + f"_b{self.batch_size}_int8.engine"
+                )
+                if os.path.exists(int8_path):
+                    self.model_path = int8_path
+                elif self._calib_thread is not None and self._calib_thread.is_alive():
+                    self.get_logger().warn(
+                        "Previous INT8 calibration still running, "
+                        "its engine will be used on the next activation"
+                    )
+                else:
+                    self._calibrate = True
+                    self.get_logger().info(
+                        f"Collecting {self.calib_num} frames for INT8 calibration"
+                    )
+
             try:
-                self.yolo = self.type_to_model[self.model_type](self.model)
+                if self.model_path != self.model:
+                    # exported models have their classes baked in
+                    self.yolo = YOLO(self.model_path)
+                else:
+                    self.yolo = self.type_to_model[self.model_type](self.model)
             except FileNotFoundError:
                 self.get_logger().error(f"Model file '{self.model}' does not exists")
                 return TransitionCallbackReturn.ERROR
-            self.get_logger().info(f"Model file '{self.model}' loaded")
+            self.get_logger().info(f"Model file '{self.model_path}' loaded")
+
+            self._is_world = isinstance(self.yolo, YOLOWorld)
 
-            if isinstance(self.yolo, YOLO) or isinstance(self.yolo, YOLOWorld):
+            # exported models are already fused
+            if (
+                isinstance(self.yolo, YOLO) or self._is_world
+            ) and self.model_path.endswith(".pt"):
+                # models load on CPU, AutoBackend moves them on the first predict
                 try:
-                    pass
                     self.get_logger().info("Trying to fuse model...")
                     self.yolo.fuse()
                 except TypeError as e:
                     self.get_logger().warn(f"Error while fuse: {e}")
 
-            self._enable_srv = self.create_service(SetBool, "enable", self.enable_cb)
+            # NHWC lets cuDNN pick Tensor Core kernels without transposes
+            self._channels_last = False
+            if self.channels_last:
+                if (
+                    "cuda" in self.device
+                    and self.half
+                    and self.model_path.endswith(".pt")
+                ):
+                    self._channels_last = True
+                    self.yolo.model.to(memory_format=torch.channels_last)
+                else:
+                    self.get_logger().warn(
+                        "Channels last requires a PyTorch model with CUDA and half"
+                    )
+
+            # letterbox on the GPU instead of the Ultralytics CPU loop
+            self._cuda_preprocess = self.cuda_preprocess and "cuda" in self.device
+            self._pinned = None
+            self._upload_event = None
+            self._gpu_imgs = None
+            self._stage_buf = None
+
+            # letterbox into buffers reused across frames
+            self._reuse_buffers = self.reuse_buffers
+            self._resize_buf = None
+            self._tensor_buf = None
+            self._tensor_buf_shapes = []
+
+            # upload frame N+1 while frame N is running on the GPU
+            self._async_pipeline = False
+            if self.async_pipeline:
+                if self._cuda_preprocess:
+                    self._async_pipeline = True
+                    self._upload_stream = torch.cuda.Stream(device=self.device)
+                    self._compute_stream = torch.cuda.Stream(device=self.device)
+                    self._frame_queue = queue.Queue(maxsize=1)
+                    self._worker = threading.Thread(
+                        target=self.inference_loop, daemon=True
+                    )
+                    self._worker.start()
+                else:
+                    self.get_logger().warn("Async pipeline requires CUDA preprocess")
+
+            if self._channels_last or self._cuda_preprocess or self._reuse_buffers:
+                self.yolo.add_callback("on_predict_start", self.setup_predictor)
+
+            self._names_list = [self.yolo.names[i] for i in range(len(self.yolo.names))]
+
+            # compile the kernel now rather than on the first frame
+            assemble_detections(
+                np.zeros((1, 4), dtype=np.float32),
+                np.zeros(1, dtype=np.int32),
+                np.zeros(1, dtype=np.float32),
+                self.threshold,
+            )
 
-            if isinstance(self.yolo, YOLOWorld):
+            self._enable_srv = self.create_service(
+                SetBool, "enable", self.enable_cb, callback_group=self._srv_cbg
+            )
+
+            # set_classes modifies the model, so it must not run during inference
+            if self._is_world:
                 self._set_classes_srv = self.create_service(
-                    SetClasses, "set_classes", self.set_classes_cb
+                    SetClasses,
+                    "set_classes",
+                    self.set_classes_cb,
+                    callback_group=self._infer_cbg,
+                )
+
+            self._output_img = None
+            self._dropped = 0
+
+            # frames are accumulated and inferred together in a single predict
+            self._batch_buf = []
+            self._batch_timer = None
+            if self.batch_size > 1:
+                self._batch_timer = self.create_timer(
+                    self.batch_timeout, self.flush_batch, callback_group=self._infer_cbg
                 )
 
             self._sub = self.create_subscription(
-                Image, "image_raw", self.image_cb, self.image_qos_profile
+                Image,
+                "image_raw",
+                self.image_cb,
+                self.image_qos_profile,
+                callback_group=self._infer_cbg,
             )
+
+            with self._state_lock:
+                self._active = True
+                self._generation += 1
+
             super().on_activate(state)
             self.get_logger().info(f"[{self.get_name()}] Activated")
 
@@ -203,20 +470,42 @@ class YoloNode(LifecycleNode):
     def on_deactivate(self, state: LifecycleState) -> TransitionCallbackReturn:
         self.get_logger().info(f"[{self.get_name()}] Deactivating...")
 
-        del self.yolo
-        if "cuda" in self.device:
-            self.get_logger().info("Clearing CUDA cache")
-            torch.cuda.empty_cache()
+        # stop new frames first, inference may still be running in another thread
+        self.destroy_subscription(self._sub)
+        self._sub = None
+
+        if self._batch_timer is not None:
+            self.destroy_timer(self._batch_timer)
+            self._batch_timer = None
+        self._batch_buf = []
+
+        # callbacks already running see the flag and drop their frames
+        with self._state_lock:
+            self._active = False
+            if self._async_pipeline:
+                # replace any pending frames with the stop sentinel
+                try:
+                    self._frame_queue.get_nowait()
+                except queue.Empty:
+                    pass
+                self._frame_queue.put(None)
+
+        if self._async_pipeline:
+            self._worker.join()
+            self._worker = None
 
         self.destroy_service(self._enable_srv)
         self._enable_srv = None
 
-        if isinstance(self.yolo, YOLOWorld):
+        if self._is_world:
             self.destroy_service(self._set_classes_srv)
             self._set_classes_srv = None
 
-        self.destroy_subscription(self._sub)
-        self._sub = None
+        with self._infer_lock:
+            del self.yolo
+        if "cuda" in self.device:
+            self.get_logger().info("Clearing CUDA cache")
+            torch.cuda.empty_cache()
 
         super().on_deactivate(state)
         self.get_logger().info(f"[{self.get_name()}] Deactivated")
@@ -231,6 +520,7 @@ class YoloNode(LifecycleNode):
             self.destroy_publisher(self._image_pub)
 
         del self.image_qos_profile
+        del self.result_img_qos_profile
 
         super().on_cleanup(state)
         self.get_logger().info(f"[{self.get_name()}] Cleaned up")
@@ -243,6 +533,282 @@ class YoloNode(LifecycleNode):
         self.get_logger().info(f"[{self.get_name()}] Shutted down")
         return TransitionCallbackReturn.SUCCESS
 
+    def export_model(self, suffix: str, **kwargs) -> str:
+
+        # reuse the file exported in a previous activation
+        export_path = os.path.splitext(self.model)[0] + suffix
+        if os.path.exists(export_path):
+            return export_path
+
+        self.get_logger().info(f"Exporting model '{self.model}' to '{export_path}'...")
+        exported_path = self.type_to_model[self.model_type](self.model).export(**kwargs)
+        os.replace(exported_path, export_path)
+        self.get_logger().info(f"Model exported to '{export_path}'")
+
+        return export_path
+
+    def setup_predictor(self, predictor: BasePredictor) -> None:
+
+        # called on every predict, wrap the preprocess only once
+        if predictor.preprocess != self.preprocess:
+            self._predictor = predictor
+            self._default_preprocess = predictor.preprocess
+            predictor.preprocess = self.preprocess
+
+    def preprocess(self, im: List[np.ndarray]) -> torch.Tensor:
+
+        if self._cuda_preprocess:
+            # frames may have been uploaded ahead by the async pipeline
+            gpu_imgs = self._gpu_imgs or [self.upload(image) for image in im]
+            shapes = [gpu_img.shape for gpu_img in gpu_imgs]
+            out_shape, regions = self.letterbox_geometry(shapes)
+            tensor_buf = self.get_tensor_buf(shapes, out_shape)
+            for gpu_img, out, region in zip(gpu_imgs, tensor_buf, regions):
+                self.letterbox(gpu_img, out, region)
+            im = tensor_buf
+        elif self._reuse_buffers:
+            shapes = [image.shape for image in im]
+            out_shape, regions = self.letterbox_geometry(shapes)
+            tensor_buf = self.get_tensor_buf(shapes, out_shape)
+            for image, out, region in zip(im, tensor_buf, regions):
+                self.cpu_letterbox(image, out, region)
+            im = tensor_buf
+        else:
+            im = self._default_preprocess(im)
+            if self._channels_last:
+                im = im.contiguous(memory_format=torch.channels_last)
+
+        return im
+
+    def upload(self, image: np.ndarray) -> torch.Tensor:
+
+        if self._pinned is None or self._pinned.shape != image.shape:
+            self._pinned = torch.empty(image.shape, dtype=torch.uint8, pin_memory=True)
+            self._upload_event = torch.cuda.Event()
+
+        # wait for the previous copy before overwriting the pinned buffer
+        self._upload_event.synchronize()
+        self._pinned.numpy()[:] = image
+
+        gpu_img = self._pinned.to(self.device, non_blocking=True)
+        self._upload_event.record()
+
+        return gpu_img
+
+    def get_tensor_buf(
+        self, shapes: List[Tuple], out_shape: Tuple[int, int]
+    ) -> torch.Tensor:
+
+        h, w = out_shape
+        dtype = torch.float16 if self._predictor.model.fp16 else torch.float32
+
+        # sized for full batches, partial ones use a slice of it
+        n = max(self.batch_size, len(shapes))
+        if (
+            self._tensor_buf is None
+            or self._tensor_buf.shape[0] < n
+            or self._tensor_buf.shape[2:] != out_shape
+            or self._tensor_buf.dtype != dtype
+        ):
+            # allocated as NHWC so channels last needs no per-frame copy
+            fmt = torch.channels_last if self._channels_last else torch.contiguous_format
+            self._tensor_buf = torch.empty(
+                (n, 3, h, w),
+                dtype=dtype,
+                device=self._predictor.device,
+                memory_format=fmt,
+            )
+            self._tensor_buf_shapes = [None] * n
+
+        # the padding only has to be redrawn when the input size changes
+        for i, shape in enumerate(shapes):
+            if self._tensor_buf_shapes[i] != shape:
+                self._tensor_buf[i].fill_(114 / 255.0)
+                self._tensor_buf_shapes[i] = shape
+
+        return self._tensor_buf[: len(shapes)]
+
+    def letterbox_geometry(
+        self, shapes: List[Tuple]
+    ) -> Tuple[Tuple[int, int], List[Tuple[int, int, int, int]]]:
+
+        # same resize and padding as the Ultralytics LetterBox, so the
+        # predictor postprocess scales boxes back to the original image
+        h, w = self._predictor.imgsz
+        model = self._predictor.model
+
+        # rect inference of PyTorch and dynamic models only pads up to a
+        # stride multiple, as in BasePredictor.pre_transform
+        auto = (
+            len({shape[:2] for shape in shapes}) == 1
+            and self._predictor.args.rect
+            and (
+                model.pt
+                or (getattr(model, "dynamic", False) and not getattr(model, "imx", False))
+            )
+        )
+
+        regions = []
+        for shape in shapes:
+            h0, w0 = shape[:2]
+            r = min(h / h0, w / w0)
+            new_h, new_w = round(h0 * r), round(w0 * r)
+            dh, dw = h - new_h, w - new_w
+            if auto:
+                dh, dw = dh % model.stride, dw % model.stride
+            regions.append((new_h, new_w, round(dh / 2 - 0.1), round(dw / 2 - 0.1)))
+
+        # all the images share the shape when padding is not to imgsz
+        out_shape = (new_h + dh, new_w + dw) if auto else (h, w)
+
+        return out_shape, regions
+
+    def letterbox(
+        self, gpu_img: torch.Tensor, out: torch.Tensor, region: Tuple[int, int, int, int]
+    ) -> None:
+
+        h0, w0 = gpu_img.shape[:2]
+        new_h, new_w, top, left = region
+        dst = out[:, top : top + new_h, left : left + new_w]
+
+        # without resize the channels are written straight into the tensor
+        if (new_h, new_w) == (h0, w0):
+            self.to_chw(gpu_img, dst)
+            return
+
+        if (
+            self._stage_buf is None
+            or self._stage_buf.shape[2:] != (h0, w0)
+            or self._stage_buf.dtype != out.dtype
+        ):
+            self._stage_buf = torch.empty(
+                (1, 3, h0, w0), dtype=out.dtype, device=out.device
+            )
+        self.to_chw(gpu_img, self._stage_buf[0])
+
+        # interpolate has no out argument, its result comes from the caching allocator
+        dst.copy_(
+            torch.nn.functional.interpolate(
+                self._stage_buf, size=(new_h, new_w), mode="bilinear", align_corners=False
+            )[0]
+        )
+
+    @staticmethod
+    def to_chw(image: torch.Tensor, out: torch.Tensor) -> None:
+
+        # HWC BGR uint8 -> CHW RGB in [0, 1], one channel at a time to
+        # avoid the temporaries of flip and dtype casts
+        for c in range(3):
+            out[c].copy_(image[..., 2 - c])
+        out.div_(255.0)
+
+    def cpu_letterbox(
+        self, image: np.ndarray, out: torch.Tensor, region: Tuple[int, int, int, int]
+    ) -> None:
+
+        new_h, new_w, top, left = region
+
+        if self._resize_buf is None or self._resize_buf.shape != (new_h, new_w, 3):
+            self._resize_buf = np.empty((new_h, new_w, 3), dtype=np.uint8)
+        cv2.resize(
+            image, (new_w, new_h), dst=self._resize_buf, interpolation=cv2.INTER_LINEAR
+        )
+
+        self.to_chw(
+            torch.from_numpy(self._resize_buf),
+            out[:, top : top + new_h, left : left + new_w],
+        )
+
+    def collect_calib_frame(self, image: np.ndarray) -> None:
+
+        # frames are kept at the inference size, not the camera resolution
+        if self._calib_buf is None:
+            h0, w0 = image.shape[:2]
+            r = min(self.imgsz_height / h0, self.imgsz_width / w0, 1.0)
+            self._calib_shape = image.shape
+            self._calib_buf = np.empty(
+                (self.calib_num, round(h0 * r), round(w0 * r), *image.shape[2:]),
+                dtype=image.dtype,
+            )
+
+        if image.shape != self._calib_shape:
+            return
+
+        out = self._calib_buf[self._calib_count]
+        if out.shape == image.shape:
+            out[:] = image
+        else:
+            cv2.resize(
+                image, (out.shape[1], out.shape[0]), dst=out, interpolation=cv2.INTER_AREA
+            )
+        self._calib_count += 1
+
+        if self._calib_count == self.calib_num:
+            calib_buf = self._calib_buf
+            self._calibrate = False
+            self._calib_buf = None
+            self._calib_thread = threading.Thread(
+                target=self.calibrate_int8,
+                args=(calib_buf, self._generation),
+                daemon=True,
+            )
+            self._calib_thread.start()
+
+    def calibrate_int8(self, calib_buf: np.ndarray, generation: int) -> None:
+
+        try:
+            # dump the frames as a dataset for the Ultralytics calibrator
+            calib_dir = os.path.abspath(os.path.splitext(self.model)[0] + "_calib")
+            images_dir = os.path.join(calib_dir, "images")
+            os.makedirs(images_dir, exist_ok=True)
+            for i, image in enumerate(calib_buf):
+                # imwrite expects BGR images
+                if self.yolo_encoding.startswith("rgb"):
+                    image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+                cv2.imwrite(os.path.join(images_dir, f"{i:06d}.jpg"), image)
+
+            data_path = os.path.join(calib_dir, "calib.yaml")
+            with open(data_path, "w") as f:
+                yaml.safe_dump(
+                    {
+                        "path": calib_dir,
+                        "train": "images",
+                        "val": "images",
+                        "names": dict(self.yolo.names),
+                    },
+                    f,
+                )
+
+            engine_path = self.export_model(
+                f"_{self.imgsz_height}x{self.imgsz_width}_b{self.batch_size}_int8.engine",
+                format="engine",
+                int8=True,
+                data=data_path,
+                imgsz=(self.imgsz_height, self.imgsz_width),
+                device=self.device,
+                dynamic=self.batch_size > 1,
+                batch=self.batch_size,
+                workspace=4,
+            )
+
+        except Exception as e:
+            self.get_logger().warn(f"Error while calibrating INT8 engine: {e}")
+            return
+
+        # load outside the lock, inference keeps running on the old model
+        yolo = YOLO(engine_path)
+        if self._cuda_preprocess or self._reuse_buffers:
+            yolo.add_callback("on_predict_start", self.setup_predictor)
+
+        # the node may have been deactivated, or reactivated, while calibrating
+        with self._infer_lock:
+            if not self._active or self._generation != generation:
+                return
+            self.yolo = yolo
+            self.model_path = engine_path
+            self._names_list = [self.yolo.names[i] for i in range(len(self.yolo.names))]
+        self.get_logger().info(f"Swapped to INT8 engine '{engine_path}'")
+
     def enable_cb(
         self,
         request: SetBool.Request,
@@ -252,65 +818,59 @@ class YoloNode(LifecycleNode):
         response.success = True
         return response
 
-    def parse_hypothesis(self, results: Results) -> List[Dict]:
-
-        hypothesis_list = []
+    def parse_arrays(
+        self, results: Results
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
 
         if results.boxes:
-            box_data: Boxes
-            for box_data in results.boxes:
-                hypothesis = {
-                    "class_id": int(box_data.cls),
-                    "class_name": self.yolo.names[int(box_data.cls)],
-                    "score": float(box_data.conf),
-                }
-                hypothesis_list.append(hypothesis)
-
-        elif results.obb:
-            for i in range(results.obb.cls.shape[0]):
-                hypothesis = {
-                    "class_id": int(results.obb.cls[i]),
-                    "class_name": self.yolo.names[int(results.obb.cls[i])],
-                    "score": float(results.obb.conf[i]),
-                }
-                hypothesis_list.append(hypothesis)
+            boxes_arr = results.boxes.xywh.cpu().numpy()
+            data = results.boxes
+        else:
+            boxes_arr = results.obb.xywhr.cpu().numpy()
+            data = results.obb
+
+        # half models give float16 and CPU results strided views, the kernel
+        # is compiled once for contiguous float32 arrays
+        return assemble_detections(
+            np.ascontiguousarray(boxes_arr, dtype=np.float32),
+            np.ascontiguousarray(data.cls.cpu().numpy(), dtype=np.int32),
+            np.ascontiguousarray(data.conf.cpu().numpy(), dtype=np.float32),
+            self.threshold,
+        )
 
-        return hypothesis_list
+    def parse_hypothesis(self, cls_arr: np.ndarray, conf_arr: np.ndarray) -> List[Dict]:
 
-    def parse_boxes(self, results: Results) -> List[BoundingBox2D]:
+        hypothesis_list = []
 
-        boxes_list = []
+        for cid, score in zip(cls_arr.tolist(), conf_arr.tolist()):
+            hypothesis = {
+                "class_id": cid,
+                "class_name": self._names_list[cid],
+                "score": score,
+            }
+            hypothesis_list.append(hypothesis)
 
-        if results.boxes:
-            box_data: Boxes
-            for box_data in results.boxes:
+        return hypothesis_list
 
-                msg = BoundingBox2D()
+    def parse_boxes(self, boxes_arr: np.ndarray) -> List[BoundingBox2D]:
 
-                # get boxes values
-                box = box_data.xywh[0]
-                msg.center.position.x = float(box[0])
-                msg.center.position.y = float(box[1])
-                msg.size.x = float(box[2])
-                msg.size.y = float(box[3])
+        boxes_list = []
 
-                # append msg
-                boxes_list.append(msg)
+        # xywh for boxes, xywhr for oriented boxes
+        for box in boxes_arr.tolist():
 
-        elif results.obb:
-            for i in range(results.obb.cls.shape[0]):
-                msg = BoundingBox2D()
+            msg = BoundingBox2D()
 
-                # get boxes values
-                box = results.obb.xywhr[i]
-                msg.center.position.x = float(box[0])
-                msg.center.position.y = float(box[1])
-                msg.center.theta = float(box[4])
-                msg.size.x = float(box[2])
-                msg.size.y = float(box[3])
+            # get boxes values
+            msg.center.position.x = box[0]
+            msg.center.position.y = box[1]
+            msg.size.x = box[2]
+            msg.size.y = box[3]
+            if len(box) == 5:
+                msg.center.theta = box[4]
 
-                # append msg
-                boxes_list.append(msg)
+            # append msg
+            boxes_list.append(msg)
 
         return boxes_list
 
@@ -318,23 +878,17 @@ class YoloNode(LifecycleNode):
 
         masks_list = []
 
-        def create_point2d(x: float, y: float) -> Point2D:
-            p = Point2D()
-            p.x = x
-            p.y = y
-            return p
+        height, width = results.orig_img.shape[:2]
 
-        mask: Masks
-        for mask in results.masks:
+        # polygons are already numpy arrays, one (N, 2) array per mask
+        xy: np.ndarray
+        for xy in results.masks.xy:
 
             msg = Mask()
 
-            msg.data = [
-                create_point2d(float(ele[0]), float(ele[1]))
-                for ele in mask.xy[0].tolist()
-            ]
-            msg.height = results.orig_img.shape[0]
-            msg.width = results.orig_img.shape[1]
+            msg.data = [Point2D(x=x, y=y) for x, y in xy.tolist()]
+            msg.height = height
+            msg.width = width
 
             masks_list.append(msg)
 
@@ -344,109 +898,266 @@ class YoloNode(LifecycleNode):
 
         keypoints_list = []
 
-        points: Keypoints
-        for points in results.keypoints:
-
-            msg_array = KeyPoint2DArray()
+        if results.keypoints.conf is None:
+            return keypoints_list
 
-            if points.conf is None:
-                continue
+        xy_arr = results.keypoints.xy.cpu().numpy()
+        conf_arr = results.keypoints.conf.cpu().numpy()
+        for xy, cf in zip(xy_arr, conf_arr):
 
-            for kp_id, (p, conf) in enumerate(zip(points.xy[0], points.conf[0])):
+            msg_array = KeyPoint2DArray()
 
-                if conf >= self.threshold:
-                    msg = KeyPoint2D()
+            # only keypoints over the threshold reach the message loop
+            for kp_id in np.flatnonzero(cf >= self.threshold):
+                msg = KeyPoint2D()
 
-                    msg.id = kp_id + 1
-                    msg.point.x = float(p[0])
-                    msg.point.y = float(p[1])
-                    msg.score = float(conf)
+                msg.id = int(kp_id) + 1
+                msg.point.x = float(xy[kp_id, 0])
+                msg.point.y = float(xy[kp_id, 1])
+                msg.score = float(cf[kp_id])
 
-                    msg_array.data.append(msg)
+                msg_array.data.append(msg)
 
             keypoints_list.append(msg_array)
 
         return keypoints_list
 
     def image_cb(self, input_img_msg: Image) -> None:
-        t0 = time.time()
-        if self.enable:
+        if self.enable and self._active:
+            if self._do_timing:
+                t0 = time.perf_counter()
 
-            # convert image + predict
+            # convert image
             input_image = self.cv_bridge.imgmsg_to_cv2(
                 input_img_msg, desired_encoding=self.yolo_encoding
             )
-            t1 = time.time()
-            results = self.yolo.predict(
-                source=input_image,
-                verbose=False,
-                stream=False,
-                conf=self.threshold,
-                iou=self.iou,
-                imgsz=(self.imgsz_height, self.imgsz_width),
-                half=self.half,
-                max_det=self.max_det,
-                augment=self.augment,
-                agnostic_nms=self.agnostic_nms,
-                retina_masks=self.retina_masks,
-                device=self.device,
+            if self._calibrate:
+                self.collect_calib_frame(input_image)
+
+            gpu_img = None
+            if self._async_pipeline:
+                with torch.cuda.stream(self._upload_stream):
+                    gpu_img = self.upload(input_image)
+
+            pre_time = time.perf_counter() - t0 if self._do_timing else 0.0
+            frame = (input_img_msg, input_image, gpu_img, pre_time)
+
+            if self.batch_size > 1:
+                self._batch_buf.append(frame)
+                if len(self._batch_buf) >= self.batch_size:
+                    self.flush_batch()
+            else:
+                self.dispatch_frames([frame])
+
+    def flush_batch(self) -> None:
+
+        if self._batch_buf:
+            frames = self._batch_buf
+            self._batch_buf = []
+            self.dispatch_frames(frames)
+
+    def dispatch_frames(self, frames: List[Tuple]) -> None:
+
+        if self._async_pipeline:
+            self.put_frames(frames)
+            return
+
+        # callbacks of the group never overlap, frames arriving meanwhile are
+        # dropped by the KEEP_LAST depth 1 subscription
+        self.process_frames(frames)
+
+    def put_frames(self, frames: List[Tuple]) -> None:
+
+        with self._state_lock:
+            # the stop sentinel may already be queued
+            if not self._active:
+                return
+
+            # keep only the newest frames, stale ones are dropped
+            try:
+                self._dropped += len(self._frame_queue.get_nowait())
+            except queue.Empty:
+                pass
+            self._frame_queue.put(frames)
+
+    def inference_loop(self) -> None:
+
+        while True:
+            frames = self._frame_queue.get()
+            if frames is None:
+                break
+
+            self._compute_stream.wait_stream(self._upload_stream)
+            for _, _, gpu_img, _ in frames:
+                gpu_img.record_stream(self._compute_stream)
+
+            try:
+                with torch.cuda.stream(self._compute_stream):
+                    self._gpu_imgs = [gpu_img for _, _, gpu_img, _ in frames]
+                    self.process_frames(frames)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self._gpu_imgs = None
+
+    def process_frames(self, frames: List[Tuple]) -> None:
+
+        # the model may be swapped or deleted by other threads
+        with self._infer_lock:
+            if self._active:
+                self.predict_frames(frames)
+
+    def predict_frames(self, frames: List[Tuple]) -> None:
+
+        # predict
+        if self._do_timing:
+            t1 = time.perf_counter()
+        results = self.yolo.predict(
+            source=[input_image for _, input_image, _, _ in frames],
+            batch=len(frames),
+            verbose=False,
+            stream=False,
+            conf=self.threshold,
+            iou=self.iou,
+            imgsz=(self.imgsz_height, self.imgsz_width),
+            half=self.half,
+            max_det=self.max_det,
+            augment=self.augment,
+            agnostic_nms=self.agnostic_nms,
+            retina_masks=self.retina_masks,
+            device=self.device,
+        )
+        if self._do_timing:
+            t2 = time.perf_counter()
+
+        detect_dict = {} if self._do_timing else None
+        for (input_img_msg, _, _, _), result in zip(frames, results):
+            self.publish_result(input_img_msg, result, detect_dict)
+
+        if self._do_timing:
+            t3 = time.perf_counter()
+            pre_time = sum(pre_time for _, _, _, pre_time in frames)
+            # only the async queue counts drops, otherwise the QoS depth drops frames
+            dropped = f", dropped={self._dropped}" if self._async_pipeline else ""
+            self.get_logger().debug(
+                f"detect: {detect_dict}, pre={pre_time:.2}s, predict={t2-t1:.2}s, "
+                f"post={t3-t2:.2}s{dropped}"
             )
-            result: Results = results[0].cpu()
-            t2 = time.time()
 
-            if result.boxes or result.obb:
-                hypothesis = self.parse_hypothesis(result)
-                boxes = self.parse_boxes(result)
+    def publish_result(
+        self, input_img_msg: Image, result: Results, detect_dict: Optional[Dict]
+    ) -> None:
 
-            if result.masks:
-                masks = self.parse_masks(result)
+        # results are kept on device, parsers only pull the arrays they need
+        keep = None
+        if result.boxes or result.obb:
+            keep, boxes_arr, cls_arr, conf_arr = self.parse_arrays(result)
+            hypothesis = self.parse_hypothesis(cls_arr, conf_arr)
+            boxes = self.parse_boxes(boxes_arr)
 
-            if result.keypoints:
-                keypoints = self.parse_keypoints(result)
+        if result.masks:
+            masks = self.parse_masks(result)
 
-            # create detection msgs
-            detections_msg = DetectionArray()
+        if result.keypoints:
+            keypoints = self.parse_keypoints(result)
 
-            detect_dict = {}
-            for i in range(len(result)):
+        # create detection msgs
+        detections_msg = DetectionArray()
 
-                aux_msg = Detection()
+        indices = keep.tolist() if keep is not None else range(len(result))
+        for i, idx in enumerate(indices):
 
-                if result.boxes or result.obb and hypothesis and boxes:
-                    aux_msg.class_id = hypothesis[i]["class_id"]
-                    aux_msg.class_name = hypothesis[i]["class_name"]
-                    aux_msg.score = hypothesis[i]["score"]
+            aux_msg = Detection()
 
-                    if aux_msg.class_name not in detect_dict:
-                        detect_dict[aux_msg.class_name] = 1
-                    else:
-                        detect_dict[aux_msg.class_name] += 1
+            if keep is not None:
+                aux_msg.class_id = hypothesis[i]["class_id"]
+                aux_msg.class_name = hypothesis[i]["class_name"]
+                aux_msg.score = hypothesis[i]["score"]
 
-                    aux_msg.bbox = boxes[i]
+                if detect_dict is not None:
+                    detect_dict[aux_msg.class_name] = (
+                        detect_dict.get(aux_msg.class_name, 0) + 1
+                    )
 
-                if result.masks and masks:
-                    aux_msg.mask = masks[i]
+                aux_msg.bbox = boxes[i]
 
-                if result.keypoints and keypoints:
-                    aux_msg.keypoints = keypoints[i]
+            if result.masks and masks:
+                aux_msg.mask = masks[idx]
 
-                detections_msg.detections.append(aux_msg)
+            if result.keypoints and keypoints:
+                aux_msg.keypoints = keypoints[idx]
 
-            # publish detections
-            detections_msg.header = input_img_msg.header
-            self._detection_pub.publish(detections_msg)
-            if self.publish_result_img:
-                output_img = result.plot()
+            detections_msg.detections.append(aux_msg)
 
-                output_img_msg = self.cv_bridge.cv2_to_imgmsg(
-                    output_img, encoding="bgr8", header=input_img_msg.header
+        # publish detections
+        detections_msg.header = input_img_msg.header
+        self._detection_pub.publish(detections_msg)
+        if self.publish_result_img:
+            # mask outlines are drawn from the polygon arrays, not the msgs
+            polygons = None
+            if result.masks:
+                polygons = [result.masks.xy[idx] for idx in indices]
+            output_img = self.draw_detections(result.orig_img, detections_msg, polygons)
+
+            # build the msg directly, generated uint8[] fields only take an
+            # array.array without a per-element check
+            output_img_msg = Image()
+            output_img_msg.header = input_img_msg.header
+            output_img_msg.height, output_img_msg.width = output_img.shape[:2]
+            output_img_msg.encoding = "bgr8"
+            output_img_msg.is_bigendian = 0
+            output_img_msg.step = output_img.shape[1] * 3
+            output_img_msg.data.frombytes(output_img)
+
+            self._image_pub.publish(output_img_msg)
+
+    def draw_detections(
+        self,
+        image: np.ndarray,
+        detections_msg: DetectionArray,
+        polygons: Optional[List[np.ndarray]],
+    ) -> np.ndarray:
+
+        # reuse the output buffer across frames
+        if self._output_img is None or self._output_img.shape != image.shape:
+            self._output_img = np.empty_like(image)
+        np.copyto(self._output_img, image)
+        output_img = self._output_img
+
+        detection: Detection
+        for i, detection in enumerate(detections_msg.detections):
+
+            color = COLORS[detection.class_id % len(COLORS)]
+            bbox = detection.bbox
+
+            if polygons is not None and len(polygons[i]):
+                cv2.polylines(output_img, [polygons[i].astype(np.int32)], True, color, 2)
+
+            corners = cv2.boxPoints(
+                (
+                    (bbox.center.position.x, bbox.center.position.y),
+                    (bbox.size.x, bbox.size.y),
+                    np.rad2deg(bbox.center.theta),
                 )
+            ).astype(np.int32)
+            cv2.polylines(output_img, [corners], True, color, 2)
+
+            x1, y1 = corners.min(axis=0)
+            cv2.putText(
+                output_img,
+                f"{detection.class_name} {detection.score:.2f}",
+                (int(x1), max(int(y1) - 4, 0)),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                0.5,
+                color,
+                1,
+                cv2.LINE_AA,
+            )
 
-                self._image_pub.publish(output_img_msg)
-            t3 = time.time()
-            self.get_logger().info(f"detect: {detect_dict}, pre={t1-t0:.2}s, predict={t2-t1:.2}s, post={t3-t2:.2}s")
-            del result
-            del input_image
+            for kp in detection.keypoints.data:
+                cv2.circle(output_img, (int(kp.point.x), int(kp.point.y)), 3, color, -1)
+
+        return output_img
 
     def set_classes_cb(
         self,
@@ -454,7 +1165,13 @@ class YoloNode(LifecycleNode):
         res: SetClasses.Response,
     ) -> SetClasses.Response:
         self.get_logger().info(f"Setting classes: {req.classes}")
-        self.yolo.set_classes(req.classes)
+
+        # the async pipeline infers outside the callback group
+        with self._infer_lock:
+            if not self._active:
+                return res
+            self.yolo.set_classes(req.classes)
+            self._names_list = [self.yolo.names[i] for i in range(len(self.yolo.names))]
         self.get_logger().info(f"New classes: {self.yolo.names}")
         return res
 
@@ -462,7 +1179,9 @@ class YoloNode(LifecycleNode):
 def main():
     rclpy.init()
     node = YoloNode()
+    executor = MultiThreadedExecutor(num_threads=3)
+    executor.add_node(node)
     try:
-        rclpy.spin(node)
+        executor.spin()
     except KeyboardInterrupt:
         pass